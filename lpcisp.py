@@ -3,6 +3,11 @@ import time
 import enum
 import serial
 
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
 part_numbers = {
     0x0402FF01: 'LPC2141',
     0x0402FF11: 'LPC2142',
@@ -50,6 +55,24 @@ class ReturnCode(enum.Enum):
     ERROR_SETTING_ACTIVE_PARTITION = 22
 
 
+# Expected raw responses, compared before anything is decoded
+_SYNCHRONIZED = b'Synchronized\r\n'
+_OK = b'OK\r\n'
+
+# Read data is sent as UU lines of 45 bytes with a checksum every 20 lines
+_UU_LINE_SIZE = 45
+_UU_BLOCK_SIZE = _UU_LINE_SIZE * 20
+
+
+class _SyncState(enum.Enum):
+    NEED_RESET = 0
+    SEND_QMARK = 1
+    EXPECT_SYNC = 2
+    EXPECT_OK = 3
+    EXPECT_CLK_OK = 4
+    DONE = 5
+
+
 class ISP(object):
     def __init__(self, port, baud, stopbits=1, timeout=2.0, tgtclk=12000, sync_timeout=30.0):
         # Don't allow an infinite timeout, this class won't work if that is used
@@ -67,6 +90,10 @@ class ISP(object):
             'sync_timeout': int(sync_timeout),
         }
         self._echo = True
+        self._rxbuf = bytearray()
+        self._uu_buf = bytearray()
+        self._cached_part = None
+        self._cached_rev = None
 
         if self._args['stopbits'] == 2:
             ser_stopbits = serial.STOPBITS_TWO
@@ -79,8 +106,17 @@ class ISP(object):
             'baudrate': self._args['baud'],
             'stopbits': ser_stopbits,
             'timeout': self._args['timeout'],
+            # Don't let an inter-byte timeout cut short large reads
+            'inter_byte_timeout': None,
         }
         self.s = serial.Serial(**s_args)
+
+        # Make sure the OS receive buffer can hold more than a few blocks of 
+        # read data, this is only supported on some platforms (Windows).
+        try:
+            self.s.set_buffer_size(rx_size=131072)
+        except AttributeError:
+            pass
         self.synchronize()
 
     @property
@@ -105,13 +141,73 @@ class ISP(object):
         # Cancel the command to reduce weird debug states
         self.s.write(b'\x1b')
         # If echo is on read that one char back
+        self._drain_echo(1)
+
+    def _drain_echo(self, size):
+        # If echo is on throw away the echoed command bytes without parsing 
+        # them as a response
         if self.echo:
-            self.s.read(1)
+            self._read(size)
+
+    def _fill(self, size):
+        # Read from the serial port until at least size bytes are buffered
+        while len(self._rxbuf) < size:
+            chunk = self.s.read(size - len(self._rxbuf))
+            if not chunk:
+                break
+            self._rxbuf += chunk
+
+    def _read(self, size):
+        # Return any buffered data first before reading from the serial port
+        self._fill(size)
+        data = bytes(self._rxbuf[:size])
+        del self._rxbuf[:size]
+        return data
+
+    def _readline(self):
+        # Read as much as is available from the serial port at once and split 
+        # the lines out of the receive buffer, this is much faster than 
+        # read_until() which reads one byte at a time.
+        timeout = self.s.timeout
+        if timeout is not None:
+            deadline = time.time() + timeout
+
+        idx = self._rxbuf.find(b'\n')
+        while idx < 0:
+            chunk = self.s.read(max(1, self.s.in_waiting))
+            if not chunk:
+                break
+            self._rxbuf += chunk
+            idx = self._rxbuf.find(b'\n', len(self._rxbuf) - len(chunk))
+            if timeout is not None and time.time() > deadline:
+                break
+
+        # If no newline was found return whatever was received
+        end = idx + 1 if idx >= 0 else len(self._rxbuf)
+        line = bytes(self._rxbuf[:end])
+        del self._rxbuf[:end]
+        return line
+
+    def _readlines(self):
+        # Read lines until the timeout is reached
+        lines = []
+        while True:
+            line = self._readline()
+            if line:
+                lines.append(line)
+            if not line.endswith(b'\n'):
+                break
+        return lines
 
     def cmd(self, cmd, return_code=True, lines=None, timeout=None):
+        # Bind the attributes used repeatedly in here to locals
+        s = self.s
+        echo = self._echo
+        readline = self._readline
+
         # Allow the default timeout to be overridden
         if timeout:
-            self.s.timeout = timeout
+            s.timeout = timeout
 
         # Ensure command is bytes
         if not isinstance(cmd, bytes):
@@ -120,12 +216,12 @@ class ISP(object):
             if cmd[-2:] != b'\r\n':
                 cmd += b'\r\n'
 
-        self.s.write(cmd)
+        s.write(cmd)
         response_lines = []
 
         # If echo is on the first response line may be an echo of the command
-        if self.echo:
-            response_lines.append(self.s.read_until())
+        if echo:
+            response_lines.append(readline())
 
             # If the line read does not match the command count it as one of the 
             # response lines
@@ -134,24 +230,24 @@ class ISP(object):
 
         # If a return code is expected, read that now
         if return_code:
-            response_lines.append(self.s.read_until())
+            response_lines.append(readline())
 
         if lines is not None:
             # if there is a specific number of lines to receive, read them now
-            response_lines.extend([self.s.read_until() for i in range(lines)])
+            response_lines.extend([readline() for i in range(lines)])
         else:
             # Otherwise just read until the timeout is reached
-            response_lines.extend(self.s.readlines())
+            response_lines.extend(self._readlines())
 
         #print(f'{cmd} -> {response_lines}')
 
         # If the timeout was modified restore the default
         if timeout:
-            self.s.timeout = self._args['timeout']
+            s.timeout = self._args['timeout']
 
         # If echo is on the first response may be an echo of the command, drop 
         # that
-        if len(response_lines) >= 1 and self.echo and response_lines[0] == cmd:
+        if len(response_lines) >= 1 and echo and response_lines[0] == cmd:
             response_lines = response_lines[1:]
 
         # If the response flag is set convert the next response line into the 
@@ -163,8 +259,12 @@ class ISP(object):
                 raise Exception(f'Command "{cmd}" Failed: {retcode}')
             response_lines = response_lines[1:]
 
-        # convert from bytes to string and drop the \r\n
-        converted_responses = [l[:-2].decode('latin-1') for l in response_lines]
+        # convert from bytes to string in one step and split on the \r\n, a 
+        # complete final line leaves an empty string at the end to drop
+        text = b''.join(response_lines).decode('latin-1')
+        converted_responses = text.split('\r\n')
+        if not converted_responses[-1]:
+            converted_responses.pop()
         if not converted_responses:
             response = None
         elif len(converted_responses) == 1:
@@ -174,37 +274,74 @@ class ISP(object):
 
         return response
 
-    def synchronize(self):
+    def synchronize(self, max_failures=3):
+        # Each sync step sends a command, if the expected response is received 
+        # move to the next step
+        steps = {
+            # Don't append \r\n to the sync byte
+            _SyncState.EXPECT_SYNC: (b'?', _SYNCHRONIZED, _SyncState.EXPECT_OK),
+            _SyncState.EXPECT_OK: (_SYNCHRONIZED, _OK, _SyncState.EXPECT_CLK_OK),
+            _SyncState.EXPECT_CLK_OK: (f'{self._args["tgtclk"]}\r\n'.encode(), _OK, _SyncState.DONE),
+        }
+
         start = time.time()
-        while True:
+        state = _SyncState.NEED_RESET
+        failures = 0
+        while state != _SyncState.DONE:
             now = time.time()
-            if now - start > 10.0:
+            if now - start > self._args['sync_timeout']:
                 raise Exception('Unable to synchronize!')
 
-            self.reset()
-            # Don't use self.cmd() because we don't want \r\n appended the sync 
-            # byte
-            response = self.cmd(b'?', return_code=False, lines=1)
-            # Response is bytes because self.cmd() wasn't used
-            if response != 'Synchronized':
-                continue
-
-            response = self.cmd('Synchronized', return_code=False, lines=1)
-            if response != 'OK':
-                continue
-
-            response = self.cmd(f'{self._args["tgtclk"]}', return_code=False, lines=1)
-            if response != 'OK':
-                continue
-
-            # success!
-            break
+            if state == _SyncState.NEED_RESET:
+                self.reset()
+                failures = 0
+                state = _SyncState.SEND_QMARK
+
+            elif state == _SyncState.SEND_QMARK:
+                # Throw away anything left over from the previous attempt
+                self.s.reset_input_buffer()
+                self._rxbuf.clear()
+                state = _SyncState.EXPECT_SYNC
+
+            else:
+                # Don't use self.cmd() so the raw response can be checked
+                cmd, expected, next_state = steps[state]
+                self.s.write(cmd)
+                response = self._readline()
+                # If echo is on the first line may be an echo of the command
+                if self.echo and response == cmd:
+                    response = self._readline()
+
+                if response == expected:
+                    state = next_state
+                elif not response:
+                    # The target is not responding, only a reset will help
+                    state = _SyncState.NEED_RESET
+                elif state == _SyncState.EXPECT_SYNC:
+                    # Probably a stray byte, so just start the sync over 
+                    # without resetting the target unless this keeps happening
+                    failures += 1
+                    if failures >= max_failures:
+                        state = _SyncState.NEED_RESET
+                    else:
+                        state = _SyncState.SEND_QMARK
+                else:
+                    # Once autobaud is done the target won't respond to '?' 
+                    # again, so a later failure can only be fixed by a reset
+                    state = _SyncState.NEED_RESET
 
     def unlock(self, code=23130):
         return self.cmd(f'U {code}')
 
-    def set_baud_rate(self):
-        return self.cmd(f'B {self._args["baud"]} {self._args["stopbits"]}')
+    def set_baud_rate(self, new_baud=None):
+        baud = int(new_baud or self._args['baud'])
+        # The only response is the return code, so don't wait for the timeout
+        response = self.cmd(f'B {baud} {self._args["stopbits"]}', lines=0)
+
+        # The target has accepted the new baud rate, switch the port to match
+        self.s.baudrate = baud
+        self._args['baud'] = baud
+        return response
 
     def _echo_cmd(self, mode):
         self.cmd('A 1')
@@ -213,21 +350,27 @@ class ISP(object):
         raise NotImplementedError
 
     def _checksum(self, data):
-        checksum = 0
-        for b in data:
-            checksum += b
-            # 2 or 4-byte checksum?
-            checksum &= 0xFFFFFFFF
-        return checksum
+        # For small amounts of data the numpy call overhead isn't worth it
+        if np is not None and len(data) > 64:
+            arr = np.frombuffer(data, dtype=np.uint8)
+            return int(arr.sum(dtype=np.uint64)) & 0xFFFFFFFF
+
+        # 2 or 4-byte checksum? python ints don't overflow so only mask once
+        return sum(data) & 0xFFFFFFFF
 
     def uudecode(self, encoded):
         # The first char of the line is the length.  The ISP tends to repeat the 
         # last byte for padding which weirds out python so round the size of the 
         # line up to a multiple of 3.
+        # Only the last line of a read is normally padded, so only copy those 
+        # lines into a mutable buffer to adjust the size.
         size = encoded[0] - 0x20
         pad = size % 3
         if pad:
-            encoded = bytes([encoded[0] + (3 - pad)]) + encoded[1:]
+            buf = self._uu_buf
+            buf[:] = encoded
+            buf[0] += 3 - pad
+            encoded = buf
         decoded = binascii.a2b_uu(encoded)
 
         # Now drop the padding bytes from the decoded data
@@ -235,44 +378,72 @@ class ISP(object):
         #print(f'{encoded} -> {decoded}')
         return decoded
 
+    def _uu_wire_size(self, size):
+        # The minimum number of bytes the ISP sends to transfer size bytes of 
+        # UU-encoded data, assuming the shortest (\n only) line endings
+        full, rem = divmod(size, _UU_LINE_SIZE)
+        wire_size = full * (1 + _UU_LINE_SIZE // 3 * 4 + 1)
+        if rem:
+            wire_size += 1 + (rem + 2) // 3 * 4 + 1
+        return wire_size
+
     def _read_data(self, size, timeout=60.0):
         #print(f'reading {size} bytes')
         # Override serial timeout
         self.s.timeout = None
 
         start = time.time()
-        data = b''
-        block_data = b''
+        data = bytearray(size)
+        offset = 0
+        # Reuse one list for the encoded lines of each block
+        block_lines = []
         blocks = 0
-        while len(data) < size:
+        while offset < size:
             now = time.time()
             if now - start > timeout:
                 self.cancel_cmd()
                 raise Exception('Read data timeout!')
 
-            line = self.s.read_until()
+            # At the start of a block read all of its UU lines from the serial 
+            # port at once, then the lines can be split out of the buffer 
+            # without going back to the serial port for each one.
+            if not block_lines:
+                self._fill(self._uu_wire_size(min(size - offset, _UU_BLOCK_SIZE)))
+
+            line = self._readline()
             #print(line)
-            # See if this is a checksum line
-            try:
-                recvd_checksum = int(line)
-                checksum = self._checksum(block_data)
-                if checksum == recvd_checksum:
-                    #print(f'BLOCK {blocks} OK ({checksum})')
-                    self.cmd('OK', return_code=False, lines=0)
-                    blocks += 1
-                    data += block_data
-                else:
-                    #print(f'BLOCK {blocks} ERROR ({checksum})')
-                    self.cmd('RESEND', return_code=False, lines=0)
-                block_data = b''
-            except ValueError:
-                decoded = self.uudecode(line)
-                block_data += decoded
+            # See if this is a checksum line, a UU line can start with a digit 
+            # so check the whole line rather than just the first char
+            digits = line.rstrip(b'\r\n')
+            if not digits.isdigit():
+                # Not a checksum, hold on to the encoded line until the whole 
+                # block has been received
+                block_lines.append(line)
+                continue
+            recvd_checksum = int(digits)
+
+            # Decode the whole block at once and then verify it
+            block_data = b''.join(self.uudecode(l) for l in block_lines)
+            checksum = self._checksum(block_data)
+            # The ACK has no response so write it directly rather than using 
+            # self.cmd()
+            if checksum == recvd_checksum:
+                #print(f'BLOCK {blocks} OK ({checksum})')
+                self.s.write(_OK)
+                self._drain_echo(len(_OK))
+                blocks += 1
+                data[offset:offset + len(block_data)] = block_data
+                offset += len(block_data)
+            else:
+                #print(f'BLOCK {blocks} ERROR ({checksum})')
+                self.s.write(b'RESEND\r\n')
+                self._drain_echo(8)
+            block_lines.clear()
 
         # restore the default timeout
         self.s.timeout = self._args['timeout']
 
-        return data
+        return bytes(data[:offset])
 
     def read_memory(self, addr, size, timeout=60.0):
         # Ensure address is word-aligned
@@ -314,30 +485,40 @@ class ISP(object):
         assert end_sector >= start_sector
         self.cmd(f'I {start_sector} {end_sector}')
 
+    def invalidate_part_id(self):
+        # Force the next read_part_id() to query the target again
+        self._cached_part = None
+        self._cached_rev = None
+
     def read_part_id(self, read_rev=False):
-        part_response = self.cmd('J')
+        # The part ID can't change during a session so only read it once
+        if self._cached_part is None:
+            part_response = self.cmd('J')
 
-        try:
-            part = part_numbers[int(part_response[1])]
-        except KeyError:
-            part = f'UNKNOWN ({part_response[1]})'
+            try:
+                part = part_numbers[int(part_response[1])]
+            except KeyError:
+                part = f'UNKNOWN ({part_response[1]})'
+            self._cached_part = part
+
+        part = self._cached_part
 
         if read_rev:
-            #rev_bytes = self.read_memory(0x7FFFE070, 4)
-            rev_bytes = self.read_memory(0x0007E070, 4)
+            if self._cached_rev is None:
+                #rev_bytes = self.read_memory(0x7FFFE070, 4)
+                rev_bytes = self.read_memory(0x0007E070, 4)
 
-            try:
-                rev_val = int(rev_bytes)
+                # The revision is a raw 32-bit little-endian word
+                rev_val = int.from_bytes(rev_bytes, 'little')
                 if rev_val == 0:
                     rev = '-'
                 elif rev_val >= 1 and rev_val <= 26:
-                    rev = 'A' + rev_val
+                    rev = chr(ord('A') + rev_val - 1)
                 else:
                     rev = f'UNKNOWN ({rev_bytes.hex()})'
-            except ValueError:
-                rev = f'UNKNOWN ({rev_bytes.hex()})'
+                self._cached_rev = rev
 
-            return (part, rev)
+            return (part, self._cached_rev)
         else:
             return part
 